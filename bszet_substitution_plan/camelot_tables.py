@@ -0,0 +1,39 @@
+#  bszet_substitution_plan
+#  Copyright (C) 2022 TKFRvision, PBahner, MarcelCoding
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import List
+
+import camelot
+from pandas import DataFrame
+
+# kept apart from util so the row_tol worker processes only have to import camelot (and not the ocr models)
+
+
+class NothingFound(Exception):
+    pass
+
+
+def read_page_tables(pdf_path: str, page_num: int, row_tol: int) -> List[DataFrame]:
+    parsed_tables = camelot.read_pdf(
+        pdf_path,
+        pages=str(page_num),
+        flavor="stream",
+        row_tol=row_tol,  # not perfect. issues often fixable here
+        table_areas=["30,480,790,100"]  # is the area big enough?
+    )
+    if len(parsed_tables) == 0:
+        raise NothingFound
+    return [parsed_table.df for parsed_table in parsed_tables]
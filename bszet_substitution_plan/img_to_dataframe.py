@@ -14,17 +14,186 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+import os
 import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from math import isclose
+from typing import Union, Dict
 
 import cv2
+import easyocr
 import numpy as np
 import pandas as pd
 from easyocr import Reader
 
 # from: https://medium.com/analytics-vidhya/how-to-detect-tables-in-images-using-opencv-and-python-6a0f15e560c3
 langs = ["de", "en"]
-reader = Reader(langs, gpu=False)
+
+# per thread scratch buffers for img_to_text. cells of one plan mostly share the same few sizes
+_scratch = threading.local()
+
+
+def _scratch_buffer(name: str, shape) -> np.ndarray:
+    buffers = getattr(_scratch, "buffers", None)
+    if buffers is None:
+        buffers = _scratch.buffers = {}
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape:
+        buffer = buffers[name] = np.empty(shape, np.uint8)
+    return buffer
+
+
+# bump this when img_to_text preprocesses the cells differently. cached results of the old version are ignored then
+_PREPROCESSING_VERSION = 2
+# the persistent cache is pruned every this many inserts
+_PRUNE_INTERVAL = 256
+
+
+class _OcrCache:
+    # lru cache for recognized cell texts. lesson numbers, class names, "Ausfall"... repeat all the time
+    # if a path is given the results are also stored in a sqlite database and survive restarts.
+    # the database keeps at most max_persistent_size of the most recently used results
+    def __init__(self, max_size: int, path: Union[str, None] = None, max_persistent_size: int = 100000):
+        self._entries = OrderedDict()
+        self._max_size = max_size
+        self._max_persistent_size = max_persistent_size
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS ocr_results "
+                             "(hash BLOB PRIMARY KEY, text TEXT NOT NULL, used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS ocr_results_used ON ocr_results (used)")
+            self._db.execute("DROP TABLE IF EXISTS ocr_cache")  # old table without versioned keys
+            self._db.commit()
+            self._prune()
+
+    @staticmethod
+    def key(img: np.ndarray, namespace: str = "") -> bytes:
+        hash_obj = hashlib.blake2b(digest_size=16)
+        # results of different preprocessing or ocr backends/models must not mix
+        hash_obj.update(f"{_PREPROCESSING_VERSION}:{namespace}".encode() + b"\0")
+        hash_obj.update(repr(img.shape).encode())  # same bytes with different shape is a different image
+        hash_obj.update(np.ascontiguousarray(img).data)
+        return hash_obj.digest()
+
+    def _remember(self, key: bytes, text: str):
+        self._entries[key] = text
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key: bytes) -> Union[str, None]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            if self._db is not None:
+                row = self._db.execute("SELECT text FROM ocr_results WHERE hash = ?", (key,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE ocr_results SET used = ? WHERE hash = ?", (time.time(), key))
+                    self._db.commit()
+                    self._remember(key, row[0])
+                    return row[0]
+        return None
+
+    def _prune(self):
+        # drop the least recently used results
+        self._db.execute("DELETE FROM ocr_results WHERE hash NOT IN "
+                         "(SELECT hash FROM ocr_results ORDER BY used DESC LIMIT ?)", (self._max_persistent_size,))
+        self._db.commit()
+
+    def put(self, key: bytes, text: str):
+        with self._lock:
+            self._remember(key, text)
+            if self._db is not None:
+                # a miss costs a whole model run, one insert more doesn't matter
+                self._db.execute("INSERT OR REPLACE INTO ocr_results (hash, text, used) VALUES (?, ?, ?)",
+                                 (key, text, time.time()))
+                self._db.commit()
+                self._inserts += 1
+                if self._inserts % _PRUNE_INTERVAL == 0:
+                    self._prune()
+
+
+_ocr_cache = _OcrCache(int(os.environ.get("OCR_CACHE_SIZE", 4096)), os.environ.get("OCR_CACHE_PATH"),
+                       int(os.environ.get("OCR_CACHE_PERSISTENT_SIZE", 100000)))
+
+
+class _EasyOcrRecognizer:
+    name = "easyocr"
+
+    def __init__(self):
+        self._reader = Reader(langs, gpu=False)
+
+    def cache_namespace(self, column: Union[int, None]) -> str:
+        return f"{self.name}-{easyocr.__version__}"  # doesn't care about the column
+
+    def recognize(self, img_dark: np.ndarray, column: Union[int, None]) -> str:
+        results_dark = self._reader.readtext(img_dark)
+        if results_dark:
+            return sort_and_join_texts(results_dark)  # sort texts
+        else:  # no text recognized
+            return ""
+
+
+class _TesseractRecognizer:
+    # way faster than easyocr on cpu for our short single line cells
+    name = "tesseract"
+    # allowed characters per column (see handle_parsing_mistakes for the column numbers). None means everything
+    _WHITELISTS = {
+        4: "0123456789.",  # lesson
+        5: "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyzÄÖÜäöü0123456789 /,-",  # classes
+    }
+
+    def __init__(self):
+        import pytesseract  # optional. only needed for this backend
+        self._pytesseract = pytesseract
+        self._version = str(pytesseract.get_tesseract_version())
+
+    def cache_namespace(self, column: Union[int, None]) -> str:
+        return f"{self.name}-{self._version}:{column}"
+
+    def recognize(self, img_dark: np.ndarray, column: Union[int, None]) -> str:
+        # cells are one line (psm 7), the date area may have more (psm 6)
+        config = "--psm 7" if column is not None else "--psm 6"
+        if (whitelist := self._WHITELISTS.get(column)) is not None:
+            config += f" -c tessedit_char_whitelist={whitelist.replace(' ', '')}"
+            config += " -c preserve_interword_spaces=1"
+        # tesseract wants dark text on light background
+        text = self._pytesseract.image_to_string(cv2.bitwise_not(img_dark), lang="deu+eng", config=config)
+        return " ".join(text.split())
+
+
+_RECOGNIZERS = {
+    _EasyOcrRecognizer.name: _EasyOcrRecognizer,
+    _TesseractRecognizer.name: _TesseractRecognizer,
+}
+_recognizer_instances: Dict[str, Union[_EasyOcrRecognizer, _TesseractRecognizer]] = {}
+_recognizer_lock = threading.Lock()
+
+
+ocr_backend = os.environ.get("OCR_BACKEND", _EasyOcrRecognizer.name)
+
+
+def get_recognizer(name: Union[str, None] = None) -> Union[_EasyOcrRecognizer, _TesseractRecognizer]:
+    # the backend is chosen with OCR_BACKEND. other backends (for the benchmark) are loaded when they are used
+    name = name or ocr_backend
+    if name not in _RECOGNIZERS:
+        raise ValueError(f"unknown ocr backend {name}. available: {', '.join(_RECOGNIZERS)}")
+    with _recognizer_lock:
+        if name not in _recognizer_instances:
+            _recognizer_instances[name] = _RECOGNIZERS[name]()
+        return _recognizer_instances[name]
+
+
+# fail on startup if OCR_BACKEND is wrong and load (or download) the model now, not on the first scanned plan
+get_recognizer()
 
 
 def find_contours(img_gray):
@@ -71,21 +240,31 @@ def sort_and_join_texts(easyocr_result):
     return recognized_text
 
 
-def img_to_text(input_img):
+def img_to_text(input_img, column: Union[int, None] = None, recognizer=None, use_cache: bool = True):
+    # column: table column of the cell (None for the date). some backends use it to restrict the characters
+    recognizer = recognizer or get_recognizer()
     (part_height, part_width) = input_img.shape[:2]
     # preprocess image
-    ret, img_bin = cv2.threshold(input_img, 150, 255, cv2.THRESH_BINARY)
-    img_bin = cv2.resize(img_bin, (part_width * 10, part_height * 10))
-    img_blurry_dark = cv2.resize(cv2.blur(255 - img_bin, (5, 5)), (part_width * 2, part_height * 2))
+    # binarize and invert in one step (dark background, light text)
+    img_bin_dark = _scratch_buffer("bin", (part_height, part_width))
+    cv2.threshold(input_img, 150, 255, cv2.THRESH_BINARY_INV, dst=img_bin_dark)
 
-    # recognize inverted image
-    results_dark = reader.readtext(img_blurry_dark)
+    # the binarized crop decides the result, so identical crops don't have to be recognized again
+    cache_key = _ocr_cache.key(img_bin_dark, recognizer.cache_namespace(column))
+    if use_cache and (cached_text := _ocr_cache.get(cache_key)) is not None:
+        return cached_text
 
-    if results_dark:
-        recognized_text = sort_and_join_texts(results_dark)  # sort texts
-    else:  # no text recognized
-        recognized_text = ""
+    # we used to scale up by 10, blur with a 5x5 box and scale down to 2x.
+    # the blur covers exactly the area of one target pixel, so this is the same as linear interpolation at 2x
+    # without allocating an image 100 times the size of the cell.
+    img_blurry_dark = _scratch_buffer("blurry", (part_height * 2, part_width * 2))
+    cv2.resize(img_bin_dark, (part_width * 2, part_height * 2), dst=img_blurry_dark, interpolation=cv2.INTER_LINEAR)
+
+    # recognize inverted image
+    recognized_text = recognizer.recognize(img_blurry_dark, column)
 
+    if use_cache:
+        _ocr_cache.put(cache_key, recognized_text)
     return recognized_text
 
 
@@ -143,8 +322,8 @@ def convert_table_img_to_list(img: np.ndarray):
 
             # select one table cell from image
             part_img = img_gray[y:y + h, x:x + w]
-            cell_text = img_to_text(part_img)  # extract text from image
             col = len(table_row) % 6
+            cell_text = img_to_text(part_img, col)  # extract text from image
             cell_text = handle_parsing_mistakes(cell_text, col)
             # text to exclude from output table
             excluded_from_table = ["bszet", "vertretungsplan", "bgy", "/", "|", "i", "[", "dubas"]
@@ -16,29 +16,45 @@
 
 import asyncio
 import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
 from glob import glob
-from typing import Iterable, Optional
+from typing import Iterable, Optional, AsyncIterator, List, Tuple, Union
 
 import sentry_sdk
-from fastapi import FastAPI, UploadFile, File, Response, Request, Header, HTTPException, Depends
+from fastapi import FastAPI, UploadFile, File, Response, Request, Header, HTTPException, Depends, Body
 from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
+from pandas import DataFrame
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 from starlette.background import BackgroundTasks
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from bszet_substitution_plan.pdf_parsing import parse_dataframes
 from bszet_substitution_plan.util import save_pdf_to_folder, create_cover_sheet, separate_pdf_into_days, \
-    convert_pdf_to_dataframes, \
-    ToDictJSONResponse
+    convert_pdf_to_dataframes_with_row_tol, file_digest, SingleFlight, DocumentTooLarge, \
+    ToDictJSONResponse, MsgpackResponse, wants_msgpack, columnar_parse_result, columnar_data_frames
+from bszet_substitution_plan.webhooks import SubscriptionRegistry, WebhookNotifier
 
 # import tempfile
 
 
 auth_key = f'Bearer {os.environ["AUTH_KEY"]}'
-row_tol = int(os.environ.get("ROW_TOL", 20))
+# "auto" tries all ROW_TOL_CANDIDATES for every page and takes the best. the first candidate wins ties
+row_tol = tuple(int(candidate) for candidate in os.environ.get("ROW_TOL_CANDIDATES", "20,10,15,25,30").split(",")) \
+    if os.environ.get("ROW_TOL", "20") == "auto" else int(os.environ.get("ROW_TOL", 20))
 image_path = os.environ["IMAGE_PATH"]
 pdf_archive_path = os.environ["PDF_ARCHIVE_PATH"]
+max_upload_size = int(os.environ.get("MAX_UPLOAD_SIZE", 20 * 1024 * 1024))  # bytes
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+# the negotiated endpoints answer json or msgpack depending on the accept header. caches must not mix them
+_VARY_ACCEPT = {"Vary": "Accept"}
+subscriptions_path = os.environ.get("SUBSCRIPTIONS_PATH", "subscriptions.json")
+# conversions run here so the event loop stays free while camelot/ocr are busy
+parse_executor = ThreadPoolExecutor(int(os.environ.get("PARSE_WORKERS", 1)))
+pdf_conversions = SingleFlight()
 
 if not os.path.exists(pdf_archive_path):
     os.mkdir(pdf_archive_path)
@@ -55,7 +71,60 @@ async def verify_authorization(authorization: Optional[str] = Header(None)):
         raise HTTPException(403, "Forbidden")
 
 
+class _UploadTooLarge(StarletteHTTPException):
+    def __init__(self):
+        super().__init__(413, "Payload Too Large")
+
+
+class UploadSizeLimitMiddleware:
+    # fastapi parses the whole multipart body before any dependency runs. so the limit has to be enforced here,
+    # while the body streams in: by the content-length header and by counting the received bytes
+    def __init__(self, app, max_size: int, paths: Iterable[str]):
+        self.app = app
+        self.max_size = max_size
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > self.max_size:
+                await PlainTextResponse("Payload Too Large", status_code=413)(scope, receive, send)
+                return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    raise _UploadTooLarge  # handled by http_exception_handler
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _UploadTooLarge:
+            # only reached if the exception got past the exception handlers
+            if response_started:
+                raise
+            await PlainTextResponse("Payload Too Large", status_code=413)(scope, receive, send)
+
+
 app = FastAPI(dependencies=(Depends(verify_authorization),))
+app.add_middleware(UploadSizeLimitMiddleware, max_size=max_upload_size,
+                   paths=("/pdf2img", "/pdf2json", "/parse-pdf", "/store-pdf"))
+webhook_notifier = WebhookNotifier(SubscriptionRegistry(subscriptions_path))
 
 if "SENTRY_DSN" in os.environ:
     sentry_sdk.init(
@@ -70,11 +139,44 @@ if "SENTRY_DSN" in os.environ:
         pass
 
 
+@app.on_event("startup")
+async def start_webhook_notifier():
+    await webhook_notifier.start()
+
+
+@app.on_event("shutdown")
+async def stop_webhook_notifier():
+    await webhook_notifier.stop()
+
+
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request, exception: StarletteHTTPException):
     return PlainTextResponse(str(exception.detail), status_code=exception.status_code)
 
 
+@app.exception_handler(DocumentTooLarge)
+async def document_too_large_handler(request, exception: DocumentTooLarge):
+    return PlainTextResponse(str(exception), status_code=413)
+
+
+@asynccontextmanager
+async def spool_upload(file: UploadFile) -> AsyncIterator[str]:
+    # copy the upload to a named file in chunks instead of reading it into memory.
+    # all the pdf libraries can work with this one path. the size is already limited by UploadSizeLimitMiddleware
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_file:
+        try:
+            while chunk := await file.read(_UPLOAD_CHUNK_SIZE):
+                tmp_file.write(chunk)
+        except BaseException:
+            tmp_file.close()
+            os.remove(tmp_file.name)
+            raise
+    try:
+        yield tmp_file.name
+    finally:
+        os.remove(tmp_file.name)
+
+
 async def remove_later(uuids: Iterable[str]):
     await asyncio.sleep(600)  # delete file after 10 minutes
     for uuid in uuids:
@@ -83,10 +185,31 @@ async def remove_later(uuids: Iterable[str]):
             os.remove(file_path)
 
 
+def _convert_shared_pdf(shared_path: str) -> Tuple[List[DataFrame], List[Union[int, None]]]:
+    try:
+        return convert_pdf_to_dataframes_with_row_tol(shared_path, row_tol)
+    finally:
+        os.remove(shared_path)
+
+
+async def convert_uploaded_pdf(pdf_path: str) -> Tuple[List[DataFrame], List[Union[int, None]]]:
+    # bots upload the same plan at the same time. identical uploads share one conversion
+    def start():
+        # the conversion gets its own link to the file. the request which started it may be gone before it's done
+        shared_path = pdf_path + ".shared"
+        os.link(pdf_path, shared_path)
+        return asyncio.get_running_loop().run_in_executor(parse_executor, _convert_shared_pdf, shared_path)
+
+    # hashing a big upload takes a moment. don't block the requests waiting for a shared conversion meanwhile
+    digest = await asyncio.get_running_loop().run_in_executor(None, file_digest, pdf_path)
+    return await pdf_conversions.run(digest, start)
+
+
 @app.post("/pdf2img")
 async def pdf2image(request: Request, background_task: BackgroundTasks, file: UploadFile = File(...)):
     # if True:
-    uuids = save_pdf_to_folder(await file.read(), image_path)
+    async with spool_upload(file) as pdf_path:
+        uuids = save_pdf_to_folder(pdf_path, image_path)
     uuids.insert(0, create_cover_sheet(
         image_path,
         request.query_params.get("top-text", None),
@@ -109,7 +232,7 @@ async def get_file(uuid: str, background_task: BackgroundTasks):
 
 
 @app.post("/pdf2json")
-async def convert_to_json(background_task: BackgroundTasks, file: UploadFile = File(...)):
+async def convert_to_json(request: Request, background_task: BackgroundTasks, file: UploadFile = File(...)):
     # with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_file:
     #     tmp_file.write(file.file.read())  # maybe read and write in chunks?!
     # try:
@@ -117,34 +240,62 @@ async def convert_to_json(background_task: BackgroundTasks, file: UploadFile = F
     #     response = [table.data for table in tables]
     # finally:
     #     background_task.add_task(os.remove, tmp_file.name)
-    return JSONResponse([df.to_dict() for df in convert_pdf_to_dataframes(await file.read(), row_tol)])
+    async with spool_upload(file) as pdf_path:
+        dfs, _ = await convert_uploaded_pdf(pdf_path)
+    if wants_msgpack(request.headers.get("accept")):
+        return MsgpackResponse(columnar_data_frames(dfs), headers=_VARY_ACCEPT)
+    return JSONResponse([df.to_dict() for df in dfs], headers=_VARY_ACCEPT)
 
 
 @app.post("/parse-pdf")
-async def parse_pdf(file: UploadFile = File(...)):
-    dfs = convert_pdf_to_dataframes(await file.read(), row_tol)
-    if dfs is None:
-        return Response("Parsing Failure", status_code=422)
-    return ToDictJSONResponse(parse_dataframes(dfs))
+async def parse_pdf(request: Request, file: UploadFile = File(...)):
+    async with spool_upload(file) as pdf_path:
+        dfs, page_row_tols = await convert_uploaded_pdf(pdf_path)
+    result = parse_dataframes(dfs)
+    result["rowTol"] = page_row_tols  # used row_tol of every page. null means ocr
+    webhook_notifier.publish(result["data"])
+    if wants_msgpack(request.headers.get("accept")):
+        return MsgpackResponse(columnar_parse_result(result), headers=_VARY_ACCEPT)
+    return ToDictJSONResponse(result, headers=_VARY_ACCEPT)
 
 
 @app.post("/store-pdf")
 async def store_pdf(file: UploadFile = File(...)):
-    data = await file.read()
-    try:
-        for pdf_files in separate_pdf_into_days(data, row_tol):
-            with open(os.path.join(pdf_archive_path, pdf_files.date_str + ".pdf"), "wb") as backup_file:
-                backup_file.write(pdf_files.pdf_data)
-        return JSONResponse({
-            "status": "OK",
-            "message": None
-        })
-    except ValueError:
-        # maybe add time?
-        with open(os.path.join(pdf_archive_path, datetime.now().strftime("failure_%Y-%m-%d") + ".pdf"), "wb") \
-                as backup_file:
-            backup_file.write(data)
+    async with spool_upload(file) as pdf_path:
+        dfs, _ = await convert_uploaded_pdf(pdf_path)
+        webhook_notifier.publish(parse_dataframes(dfs)["data"])
+        try:
+            for pdf_files in separate_pdf_into_days(pdf_path, dfs):
+                with open(os.path.join(pdf_archive_path, pdf_files.date_str + ".pdf"), "wb") as backup_file:
+                    backup_file.write(pdf_files.pdf_data)
+            return JSONResponse({
+                "status": "OK",
+                "message": None
+            })
+        except ValueError:
+            # maybe add time?
+            shutil.copyfile(pdf_path,
+                            os.path.join(pdf_archive_path, datetime.now().strftime("failure_%Y-%m-%d") + ".pdf"))
             return JSONResponse({
                 "status": "WARN",
                 "message": "The date of the PDF could not be parsed. Storing full pdf..."
             })
+
+
+@app.get("/subscriptions")
+async def list_subscriptions():
+    return JSONResponse([subscription._asdict() for subscription in webhook_notifier.registry])
+
+
+@app.post("/subscriptions")
+async def add_subscription(url: str = Body(..., embed=True)):
+    if not url.startswith(("http://", "https://")):
+        raise HTTPException(422, "Invalid URL")
+    return JSONResponse(webhook_notifier.registry.add(url)._asdict(), status_code=201)
+
+
+@app.delete("/subscriptions/{subscription_id}")
+async def remove_subscription(subscription_id: str):
+    if not webhook_notifier.registry.remove(subscription_id):
+        raise HTTPException(404, "Not Found")
+    return Response(status_code=204)
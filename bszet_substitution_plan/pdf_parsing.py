@@ -143,11 +143,15 @@ def _on_error(error: _TableFailure):
         print(colorama.Fore.RED + f"Parsing error at table {error.table_index} because {error.reason}")
 
 
-def parse_dataframes(data_frames: Iterable[DataFrame]) -> dict:
+def parse_dataframes(data_frames: Iterable[DataFrame], start_date: Union[str, None] = None,
+                     report_errors: bool = True) -> dict:
+    # start_date: date of the pages before, if data_frames doesn't start at the first page
+    # report_errors: print the failures. turned off when we are just trying different parameters
     colorama.init(autoreset=True)  # for color in error_msgs
     # print(data_frames)
+    on_error = _on_error if report_errors else lambda error: None
 
-    cur_date = None
+    cur_date = start_date
     last_parsed = None
     data_list = []
     parsing_failures = []
@@ -156,7 +160,7 @@ def parse_dataframes(data_frames: Iterable[DataFrame]) -> dict:
         # print(df)
         if len(df.columns) != 6:
             parsing_failure = _TableFailure(df_index, "amount of columns")
-            _on_error(parsing_failure)
+            on_error(parsing_failure)
             parsing_failures.append(parsing_failure)
             continue
 
@@ -165,7 +169,7 @@ def parse_dataframes(data_frames: Iterable[DataFrame]) -> dict:
             cur_date = date
         elif not cur_date:
             parsing_failure = _TableFailure(df_index, "date")
-            _on_error(parsing_failure)
+            on_error(parsing_failure)
             parsing_failures.append(parsing_failure)
             continue
 
@@ -198,7 +202,7 @@ def parse_dataframes(data_frames: Iterable[DataFrame]) -> dict:
                 for field, result in parse_results.items():
                     if result is None:
                         parsing_failure = _RowFailure(df_index, row_index, field, last_parsed)
-                        _on_error(parsing_failure)
+                        on_error(parsing_failure)
                         parsing_failures.append(parsing_failure)
                         raise _SkipObject
             except _SkipObject:
@@ -223,7 +227,7 @@ def parse_dataframes(data_frames: Iterable[DataFrame]) -> dict:
                 # I don't know what they are supposed to mean so we will skip them.
                 if action == "room-change" and room_change_to is None:
                     parsing_failure = _RowFailure(df_index, row_index, "unreadable", last_parsed)
-                    _on_error(parsing_failure)
+                    on_error(parsing_failure)
                     parsing_failures.append(parsing_failure)
                     continue
 
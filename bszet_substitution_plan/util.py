@@ -14,24 +14,33 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import hashlib
 import io
 import json
 import os
 import tempfile
-from typing import List, Tuple, Any, Union, NamedTuple, Generator
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Tuple, Any, Union, NamedTuple, Generator, Iterable, Dict, Hashable, Sequence, Callable, \
+    Awaitable
 from uuid import uuid4
 
-import camelot
+import colorama
 import cv2
+import msgpack
 import numpy as np
 import pdf2image
 from PIL import Image, ImageDraw, ImageFont
 from PyPDF2 import PdfFileReader, PdfFileWriter
 from pandas import DataFrame
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 
+from bszet_substitution_plan.camelot_tables import read_page_tables, NothingFound
 from bszet_substitution_plan.img_to_dataframe import convert_table_img_to_list
-from bszet_substitution_plan.pdf_parsing import parse_date
+from bszet_substitution_plan.pdf_parsing import parse_date, parse_dataframes
 
 _FONT_PATH = os.environ["FONT_PATH"]
 _FONT = ImageFont.truetype(_FONT_PATH, 80)
@@ -39,21 +48,75 @@ _FONT_SMALL = ImageFont.truetype(_FONT_PATH, 30)
 _BSZET_ORANGE = (238, 104, 35)
 _BSZET_GREY = (130, 129, 125)
 
+# limits for rendering. a long holiday plan shouldn't take the whole container down
+_MAX_PDF_PAGES = int(os.environ.get("MAX_PDF_PAGES", 30))
+_MAX_PAGE_PIXELS = int(os.environ.get("MAX_PAGE_PIXELS", 25_000_000))
+_MAX_STITCHED_PIXELS = int(os.environ.get("MAX_STITCHED_PIXELS", 80_000_000))
+# how many pages are rendered (in parallel) at once
+_RENDER_WINDOW = int(os.environ.get("RENDER_WINDOW", 2))
+_FALLBACK_DPI = 205  # 96
+
+_row_tol_executor: Union[ProcessPoolExecutor, None] = None
+_row_tol_executor_lock = threading.Lock()
 
-class _NothingFound(Exception):
-    pass
 
+class DocumentTooLarge(Exception):
+    pass
 
-def convert_pdf_to_img(pdf: bytes) -> bytes:
-    images = pdf2image.convert_from_bytes(pdf, 200)
 
-    widths, heights = zip(*(i.size for i in images))
-    max_width = max(widths)
-    total_height = sum(heights)
+def _pdf_page_sizes(pdf_reader: PdfFileReader, dpi: int) -> List[Tuple[int, int]]:
+    # returns the size of every page in pixels at this dpi without rendering anything
+    if (page_count := pdf_reader.getNumPages()) > _MAX_PDF_PAGES:
+        raise DocumentTooLarge(f"The PDF has {page_count} pages. At most {_MAX_PDF_PAGES} are allowed.")
+    page_sizes = []
+    for page_num in range(page_count):
+        page = pdf_reader.getPage(page_num)
+        width = round(float(page.mediaBox.getWidth()) * dpi / 72)
+        height = round(float(page.mediaBox.getHeight()) * dpi / 72)
+        rotation = page.get("/Rotate", 0)
+        if hasattr(rotation, "getObject"):  # may be an indirect object
+            rotation = rotation.getObject()
+        if int(rotation) % 180 == 90:
+            width, height = height, width
+        if width * height > _MAX_PAGE_PIXELS:
+            raise DocumentTooLarge(f"Page {page_num + 1} is too large.")
+        page_sizes.append((width, height))
+    return page_sizes
+
+
+def check_pdf_limits(pdf_path: str, dpi: int) -> List[Tuple[int, int]]:
+    with open(pdf_path, "rb") as pdf_stream:
+        return _pdf_page_sizes(PdfFileReader(pdf_stream), dpi)
+
+
+def iter_pdf_pages(pdf_path: str, dpi: int = 200, first_page: int = 1, last_page: Union[int, None] = None,
+                   page_sizes: Union[List[Tuple[int, int]], None] = None) -> Generator[Image.Image, None, None]:
+    # renders RENDER_WINDOW pages at a time, so only a few pages are in memory no matter how long the pdf is
+    # page_sizes: result of check_pdf_limits if the caller already checked the limits
+    if page_sizes is None:
+        page_sizes = check_pdf_limits(pdf_path, dpi)
+    page_count = len(page_sizes)
+    last_page = page_count if last_page is None else min(last_page, page_count)
+    for window_start in range(first_page, last_page + 1, _RENDER_WINDOW):
+        window_end = min(window_start + _RENDER_WINDOW - 1, last_page)
+        images = pdf2image.convert_from_path(pdf_path, dpi, first_page=window_start, last_page=window_end,
+                                             thread_count=window_end - window_start + 1)
+        images.reverse()
+        while images:
+            yield images.pop()  # don't keep a reference to pages which are done
+
+
+def convert_pdf_to_img(pdf_path: str) -> bytes:
+    # the canvas is allocated from the page sizes, the pages are pasted while they are rendered
+    page_sizes = check_pdf_limits(pdf_path, 200)
+    max_width = max(width for width, height in page_sizes)
+    total_height = sum(height for width, height in page_sizes)
+    if max_width * total_height > _MAX_STITCHED_PIXELS:
+        raise DocumentTooLarge("The PDF is too large to be converted into one image.")
     result_img = Image.new('RGB', (max_width, total_height))
 
     y_offset = 0
-    for image in images:
+    for image in iter_pdf_pages(pdf_path, 200, page_sizes=page_sizes):
         result_img.paste(image, (0, y_offset))
         y_offset += image.size[1]
 
@@ -63,17 +126,17 @@ def convert_pdf_to_img(pdf: bytes) -> bytes:
         return byte_array.getvalue()
 
 
-def convert_pdf_to_opencv(pdf: bytes, dpi: int = 200) -> List[np.ndarray]:
-    images = pdf2image.convert_from_bytes(pdf, dpi)
-    return [cv2.cvtColor(np.array(image.convert("RGB")), cv2.COLOR_RGB2BGR) for image in images]
+def convert_pdf_to_opencv(pdf_path: str, dpi: int = 200, first_page: int = 1, last_page: Union[int, None] = None,
+                          page_sizes: Union[List[Tuple[int, int]], None] = None) -> Generator[np.ndarray, None, None]:
+    for image in iter_pdf_pages(pdf_path, dpi, first_page, last_page, page_sizes):
+        yield cv2.cvtColor(np.array(image.convert("RGB")), cv2.COLOR_RGB2BGR)
 
 
-def save_pdf_to_folder(pdf: bytes, path: str) -> List[str]:
+def save_pdf_to_folder(pdf_path: str, path: str) -> List[str]:
     if not os.path.exists(path):
         os.mkdir(path)
     uuid_list = []
-    images = pdf2image.convert_from_bytes(pdf, 200)
-    for image in images:
+    for image in iter_pdf_pages(pdf_path, 200):
         cur_uuid = str(uuid4())
         uuid_list.append(cur_uuid)
         image.save(os.path.join(path, cur_uuid + ".jpg"), dpi=(200, 200), quality=90)
@@ -110,43 +173,153 @@ def create_cover_sheet(path: str = ".", top1: str = None, top2: str = None, bott
     return uuid
 
 
-def convert_pdf_to_dataframes(pdf: bytes, row_tol: int) -> Union[List[DataFrame], None]:
-    # i dont know if this is the right way of doing this
-    # the uploadfile object contains a file parameter which is a spooledtemporaryfile
-    # maybe there is some better way of converting the spooledtemporaryfile to a namedtemporaryfile
-    data_frames = []
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_file:
-        tmp_file.write(pdf)
+def _score_page_tables(data_frames: List[DataFrame], start_date: Union[str, None]) -> Tuple[bool, bool, int, int]:
+    # higher is better. right amount of columns, then a date, then the fewest failures, then the most rows
+    result = parse_dataframes(data_frames, start_date=start_date, report_errors=False)
+    return (
+        all(len(df.columns) == 6 for df in data_frames),
+        any(len(df.columns) > 0 and parse_date(df[0]) is not None for df in data_frames),
+        -len(result["failures"]),
+        len(result["data"])
+    )
+
+
+def _get_row_tol_executor(workers: int) -> ProcessPoolExecutor:
+    global _row_tol_executor
+    with _row_tol_executor_lock:  # pdfs may get converted in several threads
+        if _row_tol_executor is None:
+            # forkserver instead of fork. this process already runs uvicorn, the parse threads and torch
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["bszet_substitution_plan.camelot_tables"])
+            _row_tol_executor = ProcessPoolExecutor(int(os.environ.get("ROW_TOL_WORKERS", workers)),
+                                                    mp_context=context)
+        return _row_tol_executor
+
+
+def _reset_row_tol_executor(broken_executor: ProcessPoolExecutor):
+    global _row_tol_executor
+    with _row_tol_executor_lock:
+        if _row_tol_executor is broken_executor:  # another thread may have replaced it already
+            _row_tol_executor = None
+    broken_executor.shutdown(wait=False)
+
+
+def _run_row_tol_candidates(page_path: str, row_tol_candidates: Sequence[int]) -> list:
+    # results of the candidates in the same order. an exception for candidates which failed
+    executor = _get_row_tol_executor(len(row_tol_candidates))
+    futures = [executor.submit(read_page_tables, page_path, 1, row_tol) for row_tol in row_tol_candidates]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except BrokenProcessPool:
+            # a worker died (oom-killed...). the pool can't be used anymore, so the next page gets a new one
+            print(colorama.Fore.RED + "row_tol worker pool broke. Creating a new one." + colorama.Style.RESET_ALL)
+            _reset_row_tol_executor(executor)
+            raise
+        except Exception as exception:
+            results.append(exception)
+    return results
+
+
+def _read_page_tables_auto(pdf_reader: PdfFileReader, page_num: int, row_tol_candidates: Sequence[int],
+                           start_date: Union[str, None]) -> Tuple[List[DataFrame], int]:
+    # extract the page once so every candidate only has to read this small file instead of the whole document
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as page_file:
+        pdf_writer = PdfFileWriter()
+        pdf_writer.addPage(pdf_reader.getPage(page_num - 1))
+        pdf_writer.write(page_file)
     try:
-        with io.BytesIO(pdf) as pdf_stream:
-            for page_num in range(1, PdfFileReader(pdf_stream).getNumPages() + 1):
-                try:
-                    parsed_tables = camelot.read_pdf(
-                        tmp_file.name,
-                        pages=str(page_num),
-                        flavor="stream",
-                        row_tol=row_tol,  # not perfect. issues often fixable here
-                        table_areas=["30,480,790,100"]  # is the area big enough?
-                    )
-                    if len(parsed_tables) == 0:
-                        raise _NothingFound
-                    tables = [parsed_table.df for parsed_table in parsed_tables]
-                    data_frames.extend(tables)
-                except Exception:
-                    # ToDo: test exception with table from 2nd school week
-                    data_frames.extend(convert_pdf_to_dataframes_fallback(pdf, page_num - 1))
-
+        try:
+            results = _run_row_tol_candidates(page_file.name, row_tol_candidates)
+        except BrokenProcessPool:
+            results = _run_row_tol_candidates(page_file.name, row_tol_candidates)  # once more with the new pool
     finally:
-        os.remove(tmp_file.name)
+        os.remove(page_file.name)
+
+    candidates = []
+    for row_tol, data_frames in zip(row_tol_candidates, results):
+        if isinstance(data_frames, Exception):
+            continue  # this candidate doesn't work at all
+        try:
+            candidates.append((_score_page_tables(data_frames, start_date), data_frames, row_tol))
+        except Exception:
+            continue
+
+    if not candidates:
+        raise NothingFound
+    # max keeps the first of equally good candidates, so the order of the candidates is the preference
+    _, best_data_frames, best_row_tol = max(candidates, key=lambda candidate: candidate[0])
+    return best_data_frames, best_row_tol
+
+
+def convert_pdf_to_dataframes_with_row_tol(pdf_path: str, row_tol: Union[int, Sequence[int]]) \
+        -> Tuple[List[DataFrame], List[Union[int, None]]]:
+    # row_tol can be a list of candidates. then the best one is chosen for every page
+    # returns the data frames and the row_tol used for every page (None if the ocr fallback was used)
+    # the upload is spooled to a file once. camelot, PyPDF2 and pdf2image all read from that path
+    data_frames = []
+    page_row_tols = []
+    cur_date = None
+    with open(pdf_path, "rb") as pdf_stream:
+        pdf_reader = PdfFileReader(pdf_stream)
+        # checked once here. the ocr fallback doesn't have to read the document again for it
+        page_sizes = _pdf_page_sizes(pdf_reader, _FALLBACK_DPI)
+        for page_num in range(1, len(page_sizes) + 1):
+            try:
+                if isinstance(row_tol, int):
+                    tables = read_page_tables(pdf_path, page_num, row_tol)
+                    page_row_tol = row_tol
+                else:
+                    tables, page_row_tol = _read_page_tables_auto(pdf_reader, page_num, row_tol, cur_date)
+            except Exception:
+                # ToDo: test exception with table from 2nd school week
+                tables = convert_pdf_to_dataframes_fallback(pdf_path, page_num - 1, page_sizes)
+                page_row_tol = None
+            data_frames.extend(tables)
+            page_row_tols.append(page_row_tol)
+            # the date of the page is needed to score the rows of the next pages
+            for table in tables:
+                if len(table.columns) > 0 and (date := parse_date(table[0])):
+                    cur_date = date
+
+    return data_frames, page_row_tols
+
+
+def convert_pdf_to_dataframes(pdf_path: str, row_tol: Union[int, Sequence[int]]) -> Union[List[DataFrame], None]:
+    return convert_pdf_to_dataframes_with_row_tol(pdf_path, row_tol)[0]
+
+
+def convert_pdf_to_dataframes_fallback(pdf_path: str, page: int,
+                                       page_sizes: Union[List[Tuple[int, int]], None] = None) \
+        -> Union[List[DataFrame], None]:
+    # only render the page we need
+    img = next(convert_pdf_to_opencv(pdf_path, _FALLBACK_DPI, first_page=page + 1, last_page=page + 1,
+                                     page_sizes=page_sizes))
+    return [convert_table_img_to_list(img)]
 
-    return data_frames
 
+def file_digest(path: str) -> str:
+    hash_obj = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as file:
+        while chunk := file.read(64 * 1024):
+            hash_obj.update(chunk)
+    return hash_obj.hexdigest()
 
-def convert_pdf_to_dataframes_fallback(pdf: bytes, page: int) -> Union[List[DataFrame], None]:
-    # ToDo: Converting the data every time is inefficent.
-    opencv_images = convert_pdf_to_opencv(pdf, 205)  # 96
-    img = opencv_images[page]
-    return [convert_table_img_to_list(img)]
+
+class SingleFlight:
+    # concurrent calls with the same key wait for one shared computation instead of starting their own
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, start: Callable[[], Awaitable]) -> Any:
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(start())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield: one client going away must not cancel the computation for the others
+        return await asyncio.shield(future)
 
 
 class _ResultPdfPage(NamedTuple):
@@ -154,12 +327,13 @@ class _ResultPdfPage(NamedTuple):
     pdf_data: bytes
 
 
-def separate_pdf_into_days(pdf: bytes, row_tol: int) -> Generator[_ResultPdfPage, None, None]:
+def separate_pdf_into_days(pdf_path: str, data_frames: Union[List[DataFrame], None]) \
+        -> Generator[_ResultPdfPage, None, None]:
     class PdfPageDate(NamedTuple):
         date_str: str
         pdf_page_num_range: Tuple[int, int]
 
-    data_frames = convert_pdf_to_dataframes(pdf, row_tol)
+    # the data frames are passed in so the caller can use them for other things without parsing twice
     if data_frames is None:
         raise ValueError
 
@@ -179,7 +353,7 @@ def separate_pdf_into_days(pdf: bytes, row_tol: int) -> Generator[_ResultPdfPage
             date = new_date
     dates.append(PdfPageDate(date, (start_page_index, len(data_frames))))
 
-    with io.BytesIO(pdf) as pdf_input:
+    with open(pdf_path, "rb") as pdf_input:
         pdf_reader = PdfFileReader(pdf_input)
 
         for pdf_page_date in dates:
@@ -209,3 +383,122 @@ class ToDictJSONResponse(JSONResponse):
             separators=(",", ":"),
             cls=ToDictEncoder
         ).encode("utf-8")
+
+
+_MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+# fields of a substitution which get their own column in the compact format
+_SUBSTITUTION_COLUMNS = (
+    ("classes", lambda entry: entry["classes"]),
+    ("subjectFrom", lambda entry: entry["subject"]["from"]),
+    ("subjectTo", lambda entry: entry["subject"]["to"]),
+    ("roomFrom", lambda entry: entry["room"]["from"]),
+    ("roomTo", lambda entry: entry["room"]["to"]),
+    ("teacherFrom", lambda entry: entry["teacher"]["from"]),
+    ("teacherTo", lambda entry: entry["teacher"]["to"]),
+    ("date", lambda entry: entry["date"]),
+    ("message", lambda entry: entry["message"]),
+    ("action", lambda entry: entry["action"]),
+)
+
+
+def _parse_accept(accept: str) -> List[Tuple[str, float]]:
+    media_ranges = []
+    for part in accept.split(","):
+        media_range, *params = [item.strip() for item in part.split(";")]
+        if not media_range:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_ranges.append((media_range.lower(), quality))
+    return media_ranges
+
+
+def _accept_quality(media_ranges: List[Tuple[str, float]], media_type: str) -> Tuple[float, int]:
+    # q of the most specific matching range and (negated) position of it. bigger is better
+    best = None
+    for position, (media_range, quality) in enumerate(media_ranges):
+        if media_range == media_type:
+            specificity = 2
+        elif media_range == media_type.split("/")[0] + "/*":
+            specificity = 1
+        elif media_range == "*/*":
+            specificity = 0
+        else:
+            continue
+        if best is None or specificity > best[0]:
+            best = (specificity, quality, position)
+    return (best[1], -best[2]) if best else (0.0, 0)
+
+
+def wants_msgpack(accept: Union[str, None]) -> bool:
+    # json is the default. msgpack only if the client prefers it (higher q, or listed first with the same q)
+    if not accept:
+        return False
+    media_ranges = _parse_accept(accept)
+    msgpack_quality = max(_accept_quality(media_ranges, media_type) for media_type in _MSGPACK_MEDIA_TYPES)
+    return msgpack_quality[0] > 0 and msgpack_quality > _accept_quality(media_ranges, "application/json")
+
+
+class _StringTable:
+    # dictionary encoding. every distinct value is stored once and referenced by its index
+    def __init__(self):
+        self.values: List[Hashable] = []
+        self._indices: Dict[Hashable, int] = {}
+
+    def __call__(self, value: Hashable) -> Union[int, None]:
+        if value is None:
+            return None
+        if (index := self._indices.get(value)) is None:
+            index = self._indices[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+
+def columnar_parse_result(result: dict) -> dict:
+    # compact form of the parse_dataframes result. one list per field instead of one dict per substitution.
+    # classes, teachers, rooms... are indices into "strings"
+    strings = _StringTable()
+    data: List[dict] = result["data"]
+    columns: Dict[str, list] = {}
+    for name, getter in _SUBSTITUTION_COLUMNS:
+        if name == "classes":
+            columns[name] = [[strings(school_class) for school_class in getter(entry)] for entry in data]
+        else:
+            columns[name] = [strings(getter(entry)) for entry in data]
+    columns["lesson"] = [entry["lesson"] for entry in data]
+    columns["guessedAction"] = [entry["guessedAction"] for entry in data]
+    return {
+        "failures": result["failures"],
+        "rowTol": result.get("rowTol"),
+        "strings": strings.values,
+        "length": len(data),
+        "columns": columns
+    }
+
+
+def columnar_data_frames(data_frames: Iterable[DataFrame]) -> dict:
+    # compact form of the /pdf2json output. rows of string indices instead of to_dict() per data frame
+    strings = _StringTable()
+    return {
+        "tables": [[[strings(cell) for cell in row] for row in df.itertuples(index=False)] for df in data_frames],
+        "strings": strings.values
+    }
+
+
+def _msgpack_default(obj):
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+
+class MsgpackResponse(Response):
+    media_type = "application/msgpack"
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, use_bin_type=True, default=_msgpack_default)
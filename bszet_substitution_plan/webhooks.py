@@ -0,0 +1,213 @@
+#  bszet_substitution_plan
+#  Copyright (C) 2022 TKFRvision, PBahner, MarcelCoding
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple, Union
+from uuid import uuid4
+
+import aiohttp
+import colorama
+
+
+class Subscription(NamedTuple):
+    id: str
+    url: str
+
+
+class SubscriptionRegistry:
+    # subscriptions are stored in a json file so they survive restarts
+    def __init__(self, path: str):
+        self._path = path
+        self._subscriptions: Dict[str, Subscription] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as subscription_file:
+                for entry in json.load(subscription_file):
+                    self._subscriptions[entry["id"]] = Subscription(entry["id"], entry["url"])
+
+    def _save(self):
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as subscription_file:
+            json.dump([subscription._asdict() for subscription in self._subscriptions.values()], subscription_file)
+        os.replace(tmp_path, self._path)  # don't leave a half written file behind
+
+    def __iter__(self):
+        return iter(list(self._subscriptions.values()))
+
+    def __contains__(self, subscription_id: str) -> bool:
+        return subscription_id in self._subscriptions
+
+    def add(self, url: str) -> Subscription:
+        subscription = Subscription(str(uuid4()), url)
+        self._subscriptions[subscription.id] = subscription
+        self._save()
+        return subscription
+
+    def remove(self, subscription_id: str) -> bool:
+        if self._subscriptions.pop(subscription_id, None) is None:
+            return False
+        self._save()
+        return True
+
+
+class WebhookNotifier:
+    # pushes new substitutions to every subscriber.
+    # every subscriber gets its own bounded queue and worker which sends the substitutions in batches.
+    # a substitution only counts as sent to a subscriber after a successful delivery, so new subscribers get the
+    # current plan with the next upload and failed batches are sent again when the plan is uploaded again.
+    def __init__(self, registry: SubscriptionRegistry, batch_size: int = 50, batch_delay: float = 1.0,
+                 queue_size: int = 1000, max_retries: int = 5, retry_backoff: float = 1.0,
+                 timeout: float = 10.0, max_connections: int = 20, remembered_entries: int = 10000):
+        self.registry = registry
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._queue_size = queue_size
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._timeout = timeout
+        self._max_connections = max_connections
+        self._remembered_entries = remembered_entries
+        # per subscriber: keys of delivered substitutions and of the ones waiting in the queue
+        self._sent: Dict[str, "OrderedDict[str, None]"] = {}
+        self._pending: Dict[str, Set[str]] = {}
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._session: Union[aiohttp.ClientSession, None] = None
+
+    async def start(self):
+        # one session for all subscribers so connections get reused
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._max_connections),
+            timeout=aiohttp.ClientTimeout(total=self._timeout)
+        )
+
+    async def stop(self):
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers.clear()
+        self._queues.clear()
+        self._pending.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _forget(self, subscription_id: str):
+        if (worker := self._workers.pop(subscription_id, None)) is not None:
+            worker.cancel()
+        self._queues.pop(subscription_id, None)
+        self._pending.pop(subscription_id, None)
+        self._sent.pop(subscription_id, None)
+
+    def _ensure_worker(self, subscription: Subscription):
+        worker = self._workers.get(subscription.id)
+        if worker is not None and not worker.done():
+            return
+        if worker is not None:
+            # should not happen, _worker catches everything. start over instead of filling a dead queue
+            print(colorama.Fore.RED + f"Restarting webhook worker for {subscription.url}" + colorama.Style.RESET_ALL)
+        self._queues[subscription.id] = asyncio.Queue(self._queue_size)
+        self._pending[subscription.id] = set()
+        self._sent.setdefault(subscription.id, OrderedDict())
+        self._workers[subscription.id] = asyncio.create_task(
+            self._worker(subscription, self._queues[subscription.id])
+        )
+
+    def publish(self, substitutions: Iterable[dict]) -> int:
+        # returns the amount of queued events. sending happens in the background
+        if self._session is None:
+            return 0
+
+        # stop workers of removed subscriptions
+        for subscription_id in list(self._workers):
+            if subscription_id not in self.registry:
+                self._forget(subscription_id)
+
+        keyed_substitutions = [(json.dumps(substitution, sort_keys=True, ensure_ascii=False), substitution)
+                               for substitution in substitutions]
+        queued = 0
+        for subscription in self.registry:
+            self._ensure_worker(subscription)
+            queue = self._queues[subscription.id]
+            pending = self._pending[subscription.id]
+            sent = self._sent[subscription.id]
+            for key, substitution in keyed_substitutions:
+                if key in sent or key in pending:
+                    continue
+                if queue.full():
+                    # slow subscriber. drop the oldest event instead of growing without limit
+                    pending.discard(queue.get_nowait()[0])
+                queue.put_nowait((key, substitution))
+                pending.add(key)
+                queued += 1
+        return queued
+
+    def _mark_sent(self, subscription_id: str, keys: Iterable[str]):
+        sent = self._sent.setdefault(subscription_id, OrderedDict())
+        for key in keys:
+            sent[key] = None
+            sent.move_to_end(key)
+            if len(sent) > self._remembered_entries:
+                sent.popitem(last=False)
+
+    async def _worker(self, subscription: Subscription, queue: asyncio.Queue):
+        while True:
+            batch: List[Tuple[str, dict]] = [await queue.get()]
+            # wait a moment for more substitutions of the same upload
+            deadline = time.monotonic() + self._batch_delay
+            while len(batch) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            keys = [key for key, substitution in batch]
+            try:
+                delivered = await self._deliver(subscription, [substitution for key, substitution in batch])
+            except asyncio.CancelledError:
+                raise
+            except Exception as exception:
+                # a worker must not die, its queue would fill up forever
+                print(colorama.Fore.RED + f"Webhook delivery to {subscription.url} failed: {exception!r}"
+                      + colorama.Style.RESET_ALL)
+                delivered = False
+            if delivered:
+                self._mark_sent(subscription.id, keys)
+            pending = self._pending.get(subscription.id, set())
+            pending.difference_update(keys)
+
+    async def _deliver(self, subscription: Subscription, batch: List[dict]) -> bool:
+        for attempt in range(self._max_retries):
+            if attempt > 0:
+                await asyncio.sleep(self._retry_backoff * 2 ** (attempt - 1))
+            try:
+                async with self._session.post(subscription.url, json={"data": batch}) as response:
+                    if response.status < 300:
+                        return True
+                    # the subscriber doesn't want it. retrying won't help
+                    if 400 <= response.status < 500 and response.status != 429:
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        print(colorama.Fore.RED + f"Dropping {len(batch)} substitutions for webhook {subscription.url}"
+                                  + colorama.Style.RESET_ALL)
+        return False
@@ -0,0 +1,207 @@
+#  bszet_substitution_plan
+#  Copyright (C) 2022 TKFRvision, PBahner, MarcelCoding
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+from PIL import Image, ImageDraw
+
+from stats import percentile
+
+# load test for the api. either against a local uvicorn started in a subprocess or against a running server:
+#   python tools/loadtest.py --concurrency 8 --requests 200 --mix parse-pdf=3,pdf2img=1
+#   python tools/loadtest.py --url http://localhost:8000 --auth-key KEY --pid 1234 --pdf plan.pdf
+# --save-baseline writes the results to a json file, --baseline compares against one
+
+
+def synthetic_pdf(rows: int = 15, pages: int = 1) -> bytes:
+    # image only pdf which looks like a plan. camelot won't find a text layer so this goes through the ocr fallback
+    images = []
+    for page in range(pages):
+        img = Image.new("RGB", (2339, 1654), (255, 255, 255))  # A4 landscape at 200 dpi
+        draw = ImageDraw.Draw(img)
+        draw.text((100, 80), f"Vertretungsplan {page + 1:02d}.09.2022", fill=(0, 0, 0))
+        for row in range(rows + 1):
+            y = 200 + row * 90
+            for col, x in enumerate((100, 400, 600, 900, 1200, 1700)):
+                draw.rectangle((x, y, x + 280, y + 80), outline=(0, 0, 0), width=2)
+                text = ("Klasse", "Stunde", "Fach", "Raum", "Lehrkraft", "Mitteilung")[col] if row == 0 else \
+                    (f"IT {row}", f"{row % 9 + 1}.", "MA", f"B{row}", "+Mei (Sch)", "Ausfall")[col]
+                draw.text((x + 10, y + 30), text, fill=(0, 0, 0))
+        images.append(img)
+    with io.BytesIO() as pdf_stream:
+        images[0].save(pdf_stream, format="PDF", resolution=200, save_all=True, append_images=images[1:])
+        return pdf_stream.getvalue()
+
+
+def parse_mix(mix: str) -> List[Tuple[str, int]]:
+    endpoints = []
+    for part in mix.split(","):
+        endpoint, _, weight = part.partition("=")
+        endpoints.append(("/" + endpoint.strip("/"), int(weight or 1)))
+    return endpoints
+
+
+def peak_rss_mib(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as status_file:
+        for line in status_file:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def run(client: httpx.AsyncClient, pdfs: List[bytes], mix: List[Tuple[str, int]],
+              concurrency: int, total_requests: int) -> Dict[str, dict]:
+    endpoints, weights = zip(*mix)
+    schedule = random.choices(endpoints, weights, k=total_requests)
+    latencies: Dict[str, List[float]] = {endpoint: [] for endpoint in endpoints}
+    errors: Dict[str, int] = {endpoint: 0 for endpoint in endpoints}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_request(endpoint: str):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(endpoint, files={"file": ("plan.pdf", random.choice(pdfs))})
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies[endpoint].append(time.perf_counter() - start)
+            errors[endpoint] += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_request(endpoint) for endpoint in schedule))
+    duration = time.perf_counter() - start
+
+    results = {}
+    for endpoint in endpoints:
+        count = len(latencies[endpoint])
+        results[endpoint] = {
+            "requests": count,
+            "p50": percentile(latencies[endpoint], 50),
+            "p95": percentile(latencies[endpoint], 95),
+            "p99": percentile(latencies[endpoint], 99),
+            "errorRate": errors[endpoint] / count if count else 0.0,
+        }
+    results["total"] = {
+        "requests": total_requests,
+        "duration": duration,
+        "throughput": total_requests / duration,
+        "p50": percentile([latency for values in latencies.values() for latency in values], 50),
+        "p95": percentile([latency for values in latencies.values() for latency in values], 95),
+        "p99": percentile([latency for values in latencies.values() for latency in values], 99),
+        "errorRate": sum(errors.values()) / total_requests,
+    }
+    return results
+
+
+def print_results(results: Dict[str, dict], baseline: Dict[str, dict] = None):
+    for name, stats in results.items():
+        line = f"{name:<12} " + " ".join(
+            f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in stats.items()
+        )
+        print(line)
+        if baseline and name in baseline:
+            print(" " * 13 + " ".join(
+                f"{key}{value - baseline[name][key]:+.3f}" for key, value in stats.items()
+                if isinstance(value, (int, float)) and key in baseline[name]
+            ))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="load test for the substitution plan api")
+    parser.add_argument("--url", help="base url of a running server. a local server is started if missing")
+    parser.add_argument("--port", type=int, default=8765, help="port for the local server")
+    parser.add_argument("--auth-key", default=os.environ.get("AUTH_KEY", "loadtest"))
+    parser.add_argument("--pid", type=int, help="pid of the server process to measure its peak rss")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--mix", default="parse-pdf=3,pdf2img=1", help="endpoint=weight,...")
+    parser.add_argument("--pdf", action="append", default=[], help="pdf to upload. synthetic pdfs if missing")
+    parser.add_argument("--synthetic-pages", type=int, default=1)
+    parser.add_argument("--save-baseline", help="write results to this json file")
+    parser.add_argument("--baseline", help="compare results with this json file")
+    args = parser.parse_args()
+
+    pdfs = []
+    for pdf_path in args.pdf:
+        with open(pdf_path, "rb") as pdf_file:
+            pdfs.append(pdf_file.read())
+    if not pdfs:
+        pdfs = [synthetic_pdf(rows, args.synthetic_pages) for rows in (5, 15, 25)]
+
+    server = None
+    base_url = args.url
+    pid = args.pid
+    if not base_url:
+        # the server gets its own process. the handlers block their event loop, which would stall the client too.
+        # this way the peak rss is only the server's as well
+        env = dict(os.environ, AUTH_KEY=args.auth_key)
+        for key in ("IMAGE_PATH", "PDF_ARCHIVE_PATH"):
+            env.setdefault(key, os.path.abspath(os.path.join("loadtest-tmp", key.lower())))
+        env.setdefault("SUBSCRIPTIONS_PATH", os.path.abspath(os.path.join("loadtest-tmp", "subscriptions.json")))
+        os.makedirs("loadtest-tmp", exist_ok=True)
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "bszet_substitution_plan.main:app", "--host", "127.0.0.1",
+             "--port", str(args.port), "--log-level", "warning"],
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."), env=env
+        )
+        pid = server.pid
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        async with httpx.AsyncClient(base_url=base_url, headers={"Authorization": f"Bearer {args.auth_key}"},
+                                     timeout=None) as client:
+            if server is not None:
+                # wait until the server answers. any status code will do
+                while True:
+                    if server.poll() is not None:
+                        raise RuntimeError(f"server exited with {server.returncode}")
+                    try:
+                        await client.get("/")
+                        break
+                    except httpx.TransportError:
+                        await asyncio.sleep(0.2)
+            results = await run(client, pdfs, parse_mix(args.mix), args.concurrency, args.requests)
+        results["total"]["peakRssMiB"] = peak_rss_mib(pid) if pid else 0.0
+    finally:
+        if server is not None:
+            server.kill()  # don't wait for the pending background tasks (remove_later sleeps for 10 minutes)
+            server.wait()
+    results["total"]["concurrency"] = args.concurrency
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+#  bszet_substitution_plan
+#  Copyright (C) 2022 TKFRvision, PBahner, MarcelCoding
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import sys
+import time
+from difflib import SequenceMatcher
+
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from bszet_substitution_plan.img_to_dataframe import get_recognizer, img_to_text, handle_parsing_mistakes  # noqa
+from stats import percentile  # noqa
+
+# compares the ocr backends on a corpus of cell images:
+#   python tools/ocr_benchmark.py corpus/ --backend easyocr --backend tesseract
+# the corpus directory contains the cell crops and a labels.json:
+#   {"cell_001.png": {"text": "3.", "column": 4}, "date_01.png": {"text": "Montag, 05.09.2022", "column": null}}
+# columns are numbered like in handle_parsing_mistakes (4 = lesson, 5 = classes, ...)
+
+
+def benchmark(backend, corpus_path, labels):
+    recognizer = get_recognizer(backend)
+    latencies = []
+    exact = 0
+    similarity = 0.0
+    for file_name, label in labels.items():
+        img = cv2.imread(os.path.join(corpus_path, file_name), cv2.IMREAD_GRAYSCALE)
+        column = label.get("column")
+        start = time.perf_counter()
+        text = img_to_text(img, column, recognizer=recognizer, use_cache=False)
+        latencies.append(time.perf_counter() - start)
+        if column is not None:
+            text = handle_parsing_mistakes(text, column)
+        exact += text == label["text"]
+        similarity += SequenceMatcher(None, text, label["text"]).ratio()
+    return {
+        "cells": len(labels),
+        "exact": exact / len(labels),
+        "similarity": similarity / len(labels),
+        "meanMs": sum(latencies) / len(latencies) * 1000,
+        "p50Ms": percentile(latencies, 50) * 1000,
+        "p95Ms": percentile(latencies, 95) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="accuracy and latency of the ocr backends")
+    parser.add_argument("corpus", help="directory with the cell images and labels.json")
+    parser.add_argument("--backend", action="append", help="backend to test. can be given more than once")
+    parser.add_argument("--output", help="write the results to this json file")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.corpus, "labels.json"), encoding="utf-8") as labels_file:
+        labels = json.load(labels_file)
+
+    results = {}
+    for backend in args.backend or ["easyocr", "tesseract"]:
+        get_recognizer(backend)  # load the model before measuring
+        results[backend] = benchmark(backend, args.corpus, labels)
+        print(f"{backend:<10} " + " ".join(
+            f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+            for key, value in results[backend].items()
+        ))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
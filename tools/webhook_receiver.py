@@ -0,0 +1,37 @@
+#  bszet_substitution_plan
+#  Copyright (C) 2022 TKFRvision, PBahner, MarcelCoding
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import sys
+
+from aiohttp import web
+
+# stand-in subscriber for testing the webhooks locally.
+# register it with: POST /subscriptions {"url": "http://localhost:8080/"}
+# start with "fail" as argument to test the retries
+
+
+async def receive(request: web.Request) -> web.Response:
+    payload = await request.json()
+    print(json.dumps(payload, indent=2, ensure_ascii=False))
+    if "fail" in sys.argv[1:]:
+        return web.Response(status=503)
+    return web.Response(status=204)
+
+
+app = web.Application()
+app.add_routes([web.post("/", receive)])
+web.run_app(app, port=8080)